@@ -65,11 +65,7 @@ def setup(app):
     app.connect('builder-inited', build_changelog)
 
 def build_changelog(app):
-    docs_dir = os.getcwd()
-    os.chdir('../')
-    root_dir = os.getcwd()
+    root_dir = os.path.dirname(os.getcwd())
     cmd = ['bash', f"{root_dir}/tooling/build_changelog", root_dir]
-    change_proc = subprocess.run(cmd, capture_output=True, text=True)
-    print(f"change stderr returns: {change_proc.stderr}")
-    print(f"change stdout returns: {change_proc.stdout}")
-    os.chdir(docs_dir)
+    # Let the script's output stream straight to the console
+    subprocess.run(cmd, cwd=root_dir, check=False)
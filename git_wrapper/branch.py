@@ -1,13 +1,27 @@
 #! /usr/bin/env python
 """This module acts as an interface for acting on git branches"""
 
+import collections
+import contextlib
+import io
 import re
 import os
+import stat
 
 import git
+from git.compat import safe_decode
 
 from git_wrapper import exceptions
-from git_wrapper.utils.decorators import reference_exists
+from git_wrapper.utils.decorators import reference_exists, worktree_lock
+from git_wrapper.utils.env import READ_ONLY_ENV
+
+
+# git cherry -v output lines, "+ <sha> <subject>" or "- <sha> <subject>"
+_HEAD_ONLY_RE = re.compile(r'^\+ (\S+) (.*)$', re.ASCII | re.MULTILINE)
+_EQUIVALENT_RE = re.compile(r'^- (\S+) (.*)$', re.ASCII | re.MULTILINE)
+
+# Amount of git output read from a pipe at a time
+_CHUNK_SIZE = io.DEFAULT_BUFFER_SIZE * 8
 
 
 class GitBranch(object):
@@ -20,34 +34,121 @@ class GitBranch(object):
         """
         self.git_repo = git_repo
         self.logger = logger
+        # Dirty checks known to be clean, while in a batch() block
+        self._clean_checks = None
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Check the workspace is clean only once across several operations.
+
+           Inside the block, rebase_to_hash and apply_diff reuse the result of
+           an earlier clean workspace check as long as the operations since
+           then succeeded, since a successful rebase or diff application
+           leaves the workspace clean. The workspace must not be modified by
+           other means inside the block.
+        """
+        self._clean_checks = set()
+        try:
+            yield self
+        finally:
+            self._clean_checks = None
+
+    def _is_dirty(self, untracked_files=False):
+        """Check whether the workspace is dirty, unless known clean.
+
+           :param bool untracked_files: Whether untracked files count as
+                                        changes
+        """
+        if self._clean_checks and untracked_files in self._clean_checks:
+            return False
+        if self.git_repo.repo.is_dirty(untracked_files=untracked_files):
+            return True
+        if self._clean_checks is not None:
+            # Clean including untracked files implies clean without them
+            self._clean_checks.update({False, untracked_files})
+        return False
+
+    @contextlib.contextmanager
+    def _forget_clean_on_error(self):
+        """Drop the known clean state if an operation fails midway."""
+        try:
+            yield
+        except Exception:
+            if self._clean_checks is not None:
+                self._clean_checks.clear()
+            raise
 
     def _expand_file_path(self, path):
         """Expand a given path into an absolute path and check for presence.
 
            :param str path: Path
         """
-        full_path = os.path.realpath(os.path.expanduser(path))
-        if not os.path.isfile(full_path):
+        # abspath is pure string work, unlike realpath which lstat()s every
+        # path component to resolve symlinks git doesn't need resolved
+        full_path = os.path.abspath(os.path.expanduser(path))
+        try:
+            is_file = stat.S_ISREG(os.stat(full_path).st_mode)
+        except OSError:
+            is_file = False
+        if not is_file:
             msg = f"{full_path} is not a file."
             raise exceptions.FileDoesntExistException(msg)
         return full_path
 
-    def _run_cherry(self, upstream, head, regex):
-        """Run the git cherry command and return lines in a dict.
+    def _start_cherry(self, upstream, head):
+        """Start the git cherry command without waiting for its output.
 
            :param str upstream: Branch name
            :param str head: Branch name
-           :param str regex: Regular expression to run on the cherry result
         """
-        args = ['-v', upstream, head]
+        return self.git_repo.git.cherry('-v', upstream, head, as_process=True,
+                                        env=READ_ONLY_ENV)
+
+    def _stop_cherry(self, proc):
+        """Kill a started git cherry command and reap it.
+
+           :param proc: A git cherry command started with as_process=True
+        """
+        proc.proc.kill()
+        proc.proc.wait()
+
+    def _parse_cherry(self, proc, regex):
+        """Read the output of a started git cherry command into a dict.
+
+           :param proc: A git cherry command started with as_process=True
+           :param re.Pattern regex: Compiled regular expression to run on the
+                                  cherry result
+        """
         ret_data = {}
-        for line in self.git_repo.git.cherry(*args).split('\n'):
-            match = regex.match(line)
-            if match is not None:
-                ret_data[match.group(1)] = match.group(2)
+        pending = b''
+        # Read the output in chunks as git produces it rather than buffering
+        # all of it, and match all the complete lines of a chunk in a single
+        # pass of the regex engine instead of looping over them in Python
+        try:
+            for chunk in iter(lambda: proc.stdout.read(_CHUNK_SIZE), b''):
+                lines, _, pending = (pending + chunk).rpartition(b'\n')
+                ret_data.update(regex.findall(safe_decode(lines)))
+        except BaseException:
+            # Don't leave git blocked on a pipe nobody reads anymore
+            self._stop_cherry(proc)
+            raise
+        ret_data.update(regex.findall(safe_decode(pending)))
+        proc.wait()
         return ret_data
 
+    def _run_cherry(self, upstream, head, regex):
+        """Run the git cherry command and return lines in a dict.
+
+           :param str upstream: Branch name
+           :param str head: Branch name
+           :param re.Pattern regex: Compiled regular expression to run on the
+                                  cherry result
+        """
+        proc = self._start_cherry(upstream, head)
+        return self._parse_cherry(proc, regex)
+
     @reference_exists("start_ref")
+    @worktree_lock
     def create(self, name, start_ref, reset_if_exists=False, checkout=False):
         """Create a local branch based on start_ref.
 
@@ -68,10 +169,10 @@ class GitBranch(object):
                 self.git_repo.git.checkout(name)
             return True
 
-        if self.exists(name) and reset_if_exists:
+        if reset_if_exists:
+            # Leaves the branch checked out already if checkout is set
             self.hard_reset_to_ref(name, start_ref, checkout)
-
-        if checkout:
+        elif checkout:
             self.git_repo.git.checkout(name)
 
     def exists(self, name, remote=None):
@@ -82,19 +183,29 @@ class GitBranch(object):
                               if local
         """
         if not remote:
-            if name in self.git_repo.repo.branches:
-                return True
-            else:
-                return False
+            return self._ref_exists(f"refs/heads/{name}")
         else:
             if remote not in self.git_repo.remote.names():
                 raise exceptions.RemoteException(
                     f"Remote {remote} does not exist."
                 )
-            if name in self.git_repo.repo.remotes[remote].refs:
-                return True
-            else:
-                return False
+            return self._ref_exists(f"refs/remotes/{remote}/{name}")
+
+    def _ref_exists(self, path):
+        """Checks if a fully qualified reference exists.
+
+           Only the reference itself is looked up (loose ref file, then
+           packed-refs), rather than listing all the branches of the repo
+           and searching through them.
+
+           :param str path: Reference path, e.g. refs/heads/master
+        """
+        try:
+            git.SymbolicReference.dereference_recursive(self.git_repo.repo,
+                                                        path)
+        except ValueError:
+            return False
+        return True
 
     def cherry_on_head_only(self, upstream, head):
         """Get new patches between upstream and head.
@@ -105,8 +216,7 @@ class GitBranch(object):
         msg = (f"Get new patches between upstream ({upstream}) "
                f"and head ({head})")
         self.logger.debug(msg)
-        head_only_regex = re.compile(r'^\+\s(.*?)\s(.*)')
-        return self._run_cherry(upstream, head, head_only_regex)
+        return self._run_cherry(upstream, head, _HEAD_ONLY_RE)
 
     def cherry_equivalent(self, upstream, head):
         """Get patches that are in both upstream and head.
@@ -117,12 +227,48 @@ class GitBranch(object):
         msg = (f"Get patches that are in both upstream ({upstream}) "
                f"and head ({head})")
         self.logger.debug(msg)
+        return self._run_cherry(upstream, head, _EQUIVALENT_RE)
+
+    def cherry_many(self, pairs, equivalent=False):
+        """Get new patches for several upstream and head pairs at once.
 
-        equivalent_regex = re.compile(r'^\-\s(.*?)\s(.*)')
-        return self._run_cherry(upstream, head, equivalent_regex)
+           Up to one git cherry command per CPU runs at the same time, the
+           next one being started as soon as a previous one was read.
+
+           :param list pairs: (upstream, head) tuples of branch names
+           :param bool equivalent: Whether to get the patches that are in both
+                                   upstream and head instead of the new ones
+           :return dict: The cherry_on_head_only (or cherry_equivalent if
+                         equivalent is set) result for each (upstream, head)
+        """
+        regex = _EQUIVALENT_RE if equivalent else _HEAD_ONLY_RE
+        max_running = os.cpu_count() or 1
+
+        ret_data = {}
+        running = collections.deque()
+        try:
+            for upstream, head in pairs:
+                if len(running) >= max_running:
+                    pair, proc = running.popleft()
+                    ret_data[pair] = self._parse_cherry(proc, regex)
+                self.logger.debug(f"Get cherry patches between upstream "
+                                  f"({upstream}) and head ({head})")
+                proc = self._start_cherry(upstream, head)
+                running.append(((upstream, head), proc))
+
+            while running:
+                pair, proc = running.popleft()
+                ret_data[pair] = self._parse_cherry(proc, regex)
+        except BaseException:
+            # Stop the commands whose output won't be read after a failure
+            for _, proc in running:
+                self._stop_cherry(proc)
+            raise
+        return ret_data
 
     @reference_exists("branch_name")
     @reference_exists("hash_")
+    @worktree_lock
     def rebase_to_hash(self, branch_name, hash_):
         """Perform a rebase from a specific reference to another.
 
@@ -134,30 +280,32 @@ class GitBranch(object):
             f"Repo currently at commit {self.git_repo.repo.head.commit}."
         )
 
-        if self.git_repo.repo.is_dirty():
+        if self._is_dirty():
             working_dir = self.git_repo.repo.working_dir
             msg = (f"Repository {working_dir} is dirty. Please clean workspace "
                    "before proceeding.")
             raise exceptions.DirtyRepositoryException(msg)
 
-        # Checkout
-        try:
-            self.git_repo.git.checkout(branch_name)
-        except git.GitCommandError as ex:
-            msg = f"Could not checkout branch {branch_name}. Error: {ex}"
-            raise exceptions.CheckoutException(msg) from ex
+        with self._forget_clean_on_error():
+            # Checkout
+            try:
+                self.git_repo.git.checkout(branch_name)
+            except git.GitCommandError as ex:
+                msg = f"Could not checkout branch {branch_name}. Error: {ex}"
+                raise exceptions.CheckoutException(msg) from ex
 
-        # Rebase
-        try:
-            self.git_repo.git.rebase(hash_)
-        except git.GitCommandError as ex:
-            msg = (f"Could not rebase hash {hash_} onto branch {branch_name}. "
-                   f"Error: {ex}")
-            raise exceptions.RebaseException(msg) from ex
+            # Rebase
+            try:
+                self.git_repo.git.rebase(hash_)
+            except git.GitCommandError as ex:
+                msg = (f"Could not rebase hash {hash_} onto branch "
+                       f"{branch_name}. Error: {ex}")
+                raise exceptions.RebaseException(msg) from ex
 
         msg = f"Successfully rebased branch {branch_name} to {hash_}"
         self.logger.debug(msg)
 
+    @worktree_lock
     def abort_rebase(self):
         """Aborts a rebase."""
         try:
@@ -167,6 +315,7 @@ class GitBranch(object):
             raise exceptions.AbortException(msg) from ex
 
     @reference_exists('branch_name')
+    @worktree_lock
     def apply_patch(self, branch_name, path, keep_square_brackets=False):
         """Apply a git patch file on top of the specified branch.
 
@@ -174,8 +323,33 @@ class GitBranch(object):
            :param str path: Path to a git-formatted patch file (cf. git format-patch)
            :param bool keep_square_brackets: Preserve non-[PATCH] brackets in commit subject
         """
-        # Expand file (also needed for git-am) and check it exists
-        full_path = self._expand_file_path(path)
+        self._apply_patches(branch_name, [path], keep_square_brackets)
+
+    @reference_exists('branch_name')
+    @worktree_lock
+    def apply_patches(self, branch_name, paths, keep_square_brackets=False):
+        """Apply a series of git patch files on top of the specified branch.
+
+           The branch is checked out once and all the patches are applied in
+           order by a single git am command.
+
+           :param str branch_name: The name of the branch or reference to apply the patches to
+           :param list paths: Paths to git-formatted patch files (cf. git format-patch)
+           :param bool keep_square_brackets: Preserve non-[PATCH] brackets in commit subjects
+        """
+        self._apply_patches(branch_name, paths, keep_square_brackets)
+
+    def _apply_patches(self, branch_name, paths, keep_square_brackets):
+        """Apply git patch files on top of the specified branch.
+
+           :param str branch_name: The name of the branch or reference to apply the patches to
+           :param list paths: Paths to git-formatted patch files
+           :param bool keep_square_brackets: Preserve non-[PATCH] brackets in commit subjects
+        """
+        # Expand files (also needed for git-am) and check they exist
+        full_paths = [self._expand_file_path(path) for path in paths]
+        if not full_paths:
+            return
 
         # Checkout
         try:
@@ -184,18 +358,17 @@ class GitBranch(object):
             msg = f"Could not checkout branch {branch_name}. Error: {ex}"
             raise exceptions.CheckoutException(msg) from ex
 
-        # Apply the patch file
+        # Apply the patch files
+        options = ["--keep-non-patch"] if keep_square_brackets else []
         try:
-            if keep_square_brackets:
-                self.git_repo.git.am("--keep-non-patch", full_path)
-            else:
-                self.git_repo.git.am(full_path)
+            self.git_repo.git.am(*options, *full_paths)
         except git.GitCommandError as ex:
-            msg = (f"Could not apply patch {full_path} on branch "
+            msg = (f"Could not apply patch {' '.join(full_paths)} on branch "
                    f"{branch_name}. Error: {ex}")
             raise exceptions.ChangeNotAppliedException(msg) from ex
 
     @reference_exists('branch_name')
+    @worktree_lock
     def apply_diff(self, branch_name, diff_path, message, signoff=False):
         """Apply a diff on top of the specified branch.
 
@@ -205,7 +378,7 @@ class GitBranch(object):
            :param bool signoff: Whether to add signed-off-by to commit message
         """
         # Ensure we don't commit more than we mean to
-        if self.git_repo.repo.is_dirty(untracked_files=True):
+        if self._is_dirty(untracked_files=True):
             repo = self.git_repo.repo.working_dir
             msg = (f"Repository {repo} contains uncommitted changes. Please "
                    "clean workspace before proceeding.")
@@ -214,27 +387,26 @@ class GitBranch(object):
         # Check diff file exists
         full_path = self._expand_file_path(diff_path)
 
-        # Checkout
-        try:
-            self.git_repo.git.checkout(branch_name)
-        except git.GitCommandError as ex:
-            msg = f"Could not checkout branch {branch_name}. Error: {ex}"
-            raise exceptions.CheckoutException(msg) from ex
-
-        # Apply the diff
-        try:
-            self.git_repo.git.apply(full_path)
-        except git.GitCommandError as ex:
-            msg = (f"Could not apply diff {full_path} on branch "
-                   f"{branch_name}. Error: {ex}")
-            raise exceptions.ChangeNotAppliedException(msg) from ex
+        with self._forget_clean_on_error():
+            # Checkout
+            try:
+                self.git_repo.git.checkout(branch_name)
+            except git.GitCommandError as ex:
+                msg = f"Could not checkout branch {branch_name}. Error: {ex}"
+                raise exceptions.CheckoutException(msg) from ex
 
-        # The diff may have added new files, ensure they are staged
-        self.git_repo.git.add(".")
+            # Apply the diff, staging any new files it adds as well
+            try:
+                self.git_repo.git.apply("--index", full_path)
+            except git.GitCommandError as ex:
+                msg = (f"Could not apply diff {full_path} on branch "
+                       f"{branch_name}. Error: {ex}")
+                raise exceptions.ChangeNotAppliedException(msg) from ex
 
-        # Commit
-        self.git_repo.commit.commit(message, signoff)
+            # Commit
+            self.git_repo.commit.commit(message, signoff)
 
+    @worktree_lock
     def abort_patch_apply(self):
         """Abort applying a patch (git am)."""
         try:
@@ -243,6 +415,7 @@ class GitBranch(object):
             msg = f"Failed to abort git am operation. Error: {ex}"
             raise exceptions.AbortException(msg) from ex
 
+    @worktree_lock
     def reverse_diff(self, diff_path):
         """Reverse a diff that was applied to the workspace.
 
@@ -271,6 +444,7 @@ class GitBranch(object):
                             "Use GitRepo.log.short_log_diff instead.")
         return self.git_repo.log.short_log_diff(hash_from, hash_to)
 
+    @worktree_lock
     def hard_reset(self, branch="master", remote="origin",
                    remote_branch="master", refresh=True):
         """Perform a hard reset of a local branch to a remote branch.
@@ -283,9 +457,12 @@ class GitBranch(object):
         if refresh:
             self.git_repo.remote.fetch(remote)
 
-        remote_ref = f"{remote}/{remote_branch}"
+        # Use the full ref name so it resolves on the first lookup, rather
+        # than after trying it as a tag and as a local branch first
+        remote_ref = f"refs/remotes/{remote}/{remote_branch}"
         self.hard_reset_to_ref(branch, remote_ref)
 
+    @worktree_lock
     def hard_reset_to_ref(self, branch, ref, checkout=True):
         """Perform a hard reset of a local branch to any reference.
 
@@ -307,12 +484,13 @@ class GitBranch(object):
             # Detached head
             orig = self.git_repo.repo.head.commit.hexsha
 
-        # Switch to the branch
-        try:
-            self.git_repo.git.checkout(branch)
-        except git.GitCommandError as ex:
-            msg = f"Could not checkout branch {branch}. Error: {ex}"
-            raise exceptions.CheckoutException(msg) from ex
+        # Switch to the branch, unless it's already checked out
+        if orig != branch:
+            try:
+                self.git_repo.git.checkout(branch)
+            except git.GitCommandError as ex:
+                msg = f"Could not checkout branch {branch}. Error: {ex}"
+                raise exceptions.CheckoutException(msg) from ex
 
         # Reset --hard to that reference
         try:
@@ -325,7 +503,7 @@ class GitBranch(object):
             raise exceptions.ResetException(msg) from ex
 
         # Return to the original head if required
-        if not checkout:
+        if not checkout and orig != branch:
             try:
                 self.git_repo.git.checkout(orig)
             except git.GitCommandError as ex:
@@ -340,13 +518,45 @@ class GitBranch(object):
            :param str remote_branch: Remote branch to check
            :param str hash_: Commit hash to check if present
         """
-        # When used with a specific branch name, this command will
-        # return either an empty string if the commit isn't present, or
-        # the branch name provided
-        result = self.git_repo.git.branch(
-            "-r", "--contains", hash_, remote_branch
-        )
-        if result:
-            return True
-        else:
-            return False
+        # merge-base answers through its exit status alone: 0 if the commit
+        # is an ancestor of the remote branch, 1 if it isn't. Unlike
+        # "git branch -r --contains" it doesn't need to list the remote refs
+        # and stops walking history as soon as the answer is known.
+        try:
+            self.git_repo.git.merge_base("--is-ancestor", hash_, remote_branch,
+                                         env=READ_ONLY_ENV)
+        except git.GitCommandError as ex:
+            if ex.status == 1:
+                return False
+            raise
+        return True
+
+    @reference_exists('remote_branch')
+    def remote_contains_many(self, remote_branch, hashes):
+        """Check which of several commit hashes are present on a remote branch
+
+           The history of the remote branch is walked only once for all the
+           hashes, instead of once per hash as with remote_contains.
+
+           :param str remote_branch: Remote branch to check
+           :param list hashes: Commit hashes to check if present
+           :return: dict mapping each hash to whether it is present
+        """
+        commits = {}
+        for hash_ in hashes:
+            try:
+                obj = git.repo.fun.name_to_object(self.git_repo.repo, hash_)
+            except git.exc.BadName as ex:
+                msg = f"Could not find hash_ {hash_}."
+                raise exceptions.ReferenceNotFoundException(msg) from ex
+            # Annotated tags point to the commit to look for
+            while obj.type == "tag":
+                obj = obj.object
+            commits[hash_] = obj.hexsha
+
+        if not commits:
+            return {}
+
+        output = self.git_repo.git.rev_list(remote_branch, env=READ_ONLY_ENV)
+        reachable = set(output.split())
+        return {hash_: sha in reachable for hash_, sha in commits.items()}
@@ -2,6 +2,9 @@
 """Decorator utilities"""
 
 import inspect
+import os
+import threading
+import weakref
 
 import git
 import wrapt
@@ -21,3 +24,33 @@ def reference_exists(ref):
             raise exceptions.ReferenceNotFoundException(msg) from ex
         return func(*args, **kwargs)
     return wrapper
+
+
+# One lock per working tree, shared by all the objects operating on it
+_WORKTREE_LOCKS = weakref.WeakValueDictionary()
+_WORKTREE_LOCKS_GUARD = threading.Lock()
+
+
+def _worktree_lock(path):
+    """Get the lock for the working tree at path, creating it if needed.
+
+       :param str path: Path to the working tree
+    """
+    key = os.path.realpath(path)
+    with _WORKTREE_LOCKS_GUARD:
+        lock = _WORKTREE_LOCKS.get(key)
+        if lock is None:
+            lock = _WORKTREE_LOCKS[key] = threading.RLock()
+    return lock
+
+
+@wrapt.decorator
+def worktree_lock(func, instance, args, kwargs):
+    """Serialize the calls modifying the same working tree.
+
+       Git fails rather than waits when another command holds the index
+       lock, so threads checking out, resetting or applying changes on the
+       same working tree wait for their turn instead.
+    """
+    with _worktree_lock(instance.git_repo.repo.working_dir):
+        return func(*args, **kwargs)
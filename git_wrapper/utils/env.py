@@ -0,0 +1,7 @@
+#! /usr/bin/env python
+"""Environment utilities"""
+
+# Environment for git commands that only read from the repository. They
+# skip optional locks such as the one taken to refresh the index, so they
+# don't contend with other git commands running on the same repository.
+READ_ONLY_ENV = {'GIT_OPTIONAL_LOCKS': '0'}
@@ -3,7 +3,8 @@
 
 from collections import namedtuple
 from datetime import datetime
-from mock import Mock
+import io
+from mock import Mock, patch
 
 import git
 from git.util import IterableList
@@ -24,8 +25,22 @@ def mock_repo():
 
     repo_mock.remotes = remote_list
     repo_mock.branches = []
+    repo_mock.working_dir = "/tmp/repo"
 
-    return repo_mock
+    def dereference(repo, ref_path):
+        """Resolve refs against the branches and remote refs set up above"""
+        if ref_path.startswith("refs/heads/"):
+            found = ref_path[len("refs/heads/"):] in repo_mock.branches
+        else:
+            remote, _, name = ref_path[len("refs/remotes/"):].partition("/")
+            found = name in repo_mock.remotes[remote].refs
+        if not found:
+            raise ValueError(f"Reference at {ref_path} does not exist")
+        return "0" * 40
+
+    with patch('git.SymbolicReference.dereference_recursive',
+               side_effect=dereference):
+        yield repo_mock
 
 
 @pytest.fixture
@@ -50,3 +65,13 @@ def fake_commits(count=3):
         commits.append(commit)
 
     return commits
+
+
+@pytest.fixture
+def git_process():
+    """Factory for mocks of git commands run with as_process=True"""
+    def _git_process(output):
+        proc = Mock()
+        proc.stdout = io.BytesIO(output.encode())
+        return proc
+    return _git_process
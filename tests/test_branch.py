@@ -1,6 +1,9 @@
 #! /usr/bin/env python
 """Tests for GitBranch"""
 
+import os
+import threading
+
 from mock import ANY, Mock, patch
 
 import git
@@ -8,9 +11,11 @@ import pytest
 
 from git_wrapper.repo import GitRepo
 from git_wrapper import exceptions
+from git_wrapper.utils.decorators import _worktree_lock
+from git_wrapper.utils.env import READ_ONLY_ENV
 
 
-def test_on_head_only_all_new(mock_repo):
+def test_on_head_only_all_new(mock_repo, git_process):
     """
     GIVEN GitRepo initialized with a path and repo
     WHEN on_head_only method is called with no upstream equivalent changes
@@ -18,13 +23,12 @@ def test_on_head_only_all_new(mock_repo):
     """
     repo = GitRepo('./', mock_repo)
     lines = '+ sha1 commit1\n+ sha2 commit2\n+ sha3 commit3'
-    attrs = {'cherry.return_value': lines}
-    mock_repo.git.configure_mock(**attrs)
+    mock_repo.git.cherry.return_value = git_process(lines)
     expected = {'sha1': 'commit1', 'sha2': 'commit2', 'sha3': 'commit3'}
     assert expected == repo.branch.cherry_on_head_only('upstream', 'HEAD')
 
 
-def test_on_head_only_with_mixed(mock_repo):
+def test_on_head_only_with_mixed(mock_repo, git_process):
     """
     GIVEN GitRepo initialized with a path and repo
     WHEN on_head_only method is called with a mix of
@@ -33,13 +37,12 @@ def test_on_head_only_with_mixed(mock_repo):
     """
     repo = GitRepo('./', mock_repo)
     lines = '+ sha1 commit1\n- sha2 commit2\n+ sha3 commit3'
-    attrs = {'cherry.return_value': lines}
-    mock_repo.git.configure_mock(**attrs)
+    mock_repo.git.cherry.return_value = git_process(lines)
     expected = {'sha1': 'commit1', 'sha3': 'commit3'}
     assert expected == repo.branch.cherry_on_head_only('upstream', 'HEAD')
 
 
-def test_on_head_only_no_new(mock_repo):
+def test_on_head_only_no_new(mock_repo, git_process):
     """
     GIVEN GitRepo initialized with a path and repo
     WHEN on_head_only method is called with a only upstream equivalent changes
@@ -47,12 +50,11 @@ def test_on_head_only_no_new(mock_repo):
     """
     repo = GitRepo('./', mock_repo)
     lines = '- sha1 commit1\n- sha2 commit2\n- sha3 commit3'
-    attrs = {'cherry.return_value': lines}
-    mock_repo.git.configure_mock(**attrs)
+    mock_repo.git.cherry.return_value = git_process(lines)
     assert {} == repo.branch.cherry_on_head_only('upstream', 'HEAD')
 
 
-def test_on_head_only_empty(mock_repo):
+def test_on_head_only_empty(mock_repo, git_process):
     """
     GIVEN GitRepo initialized with a path and repo
     WHEN on_head_only is called with no changes
@@ -60,12 +62,11 @@ def test_on_head_only_empty(mock_repo):
     """
     repo = GitRepo('./', mock_repo)
     lines = ''
-    attrs = {'cherry.return_value': lines}
-    mock_repo.git.configure_mock(**attrs)
+    mock_repo.git.cherry.return_value = git_process(lines)
     assert {} == repo.branch.cherry_on_head_only('upstream', 'HEAD')
 
 
-def test_all_equivalent_changes(mock_repo):
+def test_all_equivalent_changes(mock_repo, git_process):
     """
     GIVEN GitRepo initialized with a path and repo
     WHEN equivalent is called with only equivalent upstream/downstream changes.
@@ -73,13 +74,15 @@ def test_all_equivalent_changes(mock_repo):
     """
     repo = GitRepo('./', mock_repo)
     lines = '- sha1 commit1\n- sha2 commit2\n- sha3 commit3'
-    attrs = {'cherry.return_value': lines}
-    mock_repo.git.configure_mock(**attrs)
+    mock_repo.git.cherry.return_value = git_process(lines)
     expected = {'sha1': 'commit1', 'sha2': 'commit2', 'sha3': 'commit3'}
     assert expected == repo.branch.cherry_equivalent('upstream', 'HEAD')
+    mock_repo.git.cherry.assert_called_once_with(
+        '-v', 'upstream', 'HEAD', as_process=True, env=READ_ONLY_ENV
+    )
 
 
-def test_equivalent_mixed_changes(mock_repo):
+def test_equivalent_mixed_changes(mock_repo, git_process):
     """
     GIVEN GitRepo initialized with a path and repo
     WHEN equivalent is called with mix equivalent and HEAD changes.
@@ -87,13 +90,12 @@ def test_equivalent_mixed_changes(mock_repo):
     """
     repo = GitRepo('./', mock_repo)
     lines = '+ sha1 commit1\n- sha2 commit2\n+ sha3 commit3'
-    attrs = {'cherry.return_value': lines}
-    mock_repo.git.configure_mock(**attrs)
+    mock_repo.git.cherry.return_value = git_process(lines)
     expected = {'sha2': 'commit2'}
     assert expected == repo.branch.cherry_equivalent('upstream', 'HEAD')
 
 
-def test_equivalent_downstream_only(mock_repo):
+def test_equivalent_downstream_only(mock_repo, git_process):
     """
     GIVEN GitRepo initialized with a path and repo
     WHEN equivalent is called with mix HEAD only changes.
@@ -101,12 +103,11 @@ def test_equivalent_downstream_only(mock_repo):
     """
     repo = GitRepo('./', mock_repo)
     lines = '+ sha1 commit1\n+ sha2 commit2\n+ sha3 commit3'
-    attrs = {'cherry.return_value': lines}
-    mock_repo.git.configure_mock(**attrs)
+    mock_repo.git.cherry.return_value = git_process(lines)
     assert {} == repo.branch.cherry_equivalent('upstream', 'HEAD')
 
 
-def test_equivalent_no_changes(mock_repo):
+def test_equivalent_no_changes(mock_repo, git_process):
     """
     GIVEN GitRepo initialized with a path and repo
     WHEN equivalent is called with no changes.
@@ -114,11 +115,97 @@ def test_equivalent_no_changes(mock_repo):
     """
     repo = GitRepo('./', mock_repo)
     lines = ''
-    attrs = {'cherry.return_value': lines}
-    mock_repo.git.configure_mock(**attrs)
+    mock_repo.git.cherry.return_value = git_process(lines)
     assert {} == repo.branch.cherry_equivalent('upstream', 'HEAD')
 
 
+def test_on_head_only_across_chunks(mock_repo, git_process):
+    """
+    GIVEN GitRepo initialized with a path and repo
+    WHEN on_head_only method is called
+    AND the git cherry output is read in several chunks
+    THEN lines split across chunks are parsed whole
+    """
+    repo = GitRepo('./', mock_repo)
+    lines = '\n'.join(f'+ sha{i} commit{i}' for i in range(200)) + '\n'
+    mock_repo.git.cherry.return_value = git_process(lines)
+    expected = {f'sha{i}': f'commit{i}' for i in range(200)}
+    with patch('git_wrapper.branch._CHUNK_SIZE', 7):
+        assert expected == repo.branch.cherry_on_head_only('upstream', 'HEAD')
+
+
+def test_cherry_error(mock_repo, git_process):
+    """
+    GIVEN GitRepo initialized with a path and repo
+    WHEN cherry_on_head_only is called
+    AND git cherry exits with an error
+    THEN the git.GitCommandError is raised
+    """
+    repo = GitRepo('./', mock_repo)
+    proc = git_process('')
+    proc.wait.side_effect = git.GitCommandError('cherry', 128)
+    mock_repo.git.cherry.return_value = proc
+    with pytest.raises(git.GitCommandError):
+        repo.branch.cherry_on_head_only('upstream', 'HEAD')
+
+
+def test_cherry_many(mock_repo, git_process):
+    """
+    GIVEN GitRepo initialized with a path and repo
+    WHEN cherry_many is called with several upstream and head pairs
+    THEN git cherry is run once for each pair
+    AND a dictionary of new patches is returned for each pair
+    """
+    repo = GitRepo('./', mock_repo)
+    outputs = {'HEAD': '+ sha1 commit1\n- sha2 commit2',
+               'other': '- sha3 commit3\n+ sha4 commit4'}
+    mock_repo.git.cherry.side_effect = (
+        lambda _, upstream, head, **kwargs: git_process(outputs[head])
+    )
+    expected = {('upstream', 'HEAD'): {'sha1': 'commit1'},
+                ('upstream', 'other'): {'sha4': 'commit4'}}
+    pairs = [('upstream', 'HEAD'), ('upstream', 'other')]
+    with patch('os.cpu_count', return_value=1):
+        assert expected == repo.branch.cherry_many(pairs)
+    assert mock_repo.git.cherry.call_count == 2
+
+
+def test_cherry_many_error(mock_repo, git_process):
+    """
+    GIVEN GitRepo initialized with a path and repo
+    WHEN cherry_many is called with several upstream and head pairs
+    AND one of the git cherry commands exits with an error
+    THEN the git.GitCommandError is raised
+    AND the git cherry commands still running are stopped
+    """
+    repo = GitRepo('./', mock_repo)
+    failing, running = git_process(''), git_process('+ sha1 commit1')
+    failing.wait.side_effect = git.GitCommandError('cherry', 128)
+    mock_repo.git.cherry.side_effect = [failing, running]
+    pairs = [('upstream', 'HEAD'), ('upstream', 'other')]
+    with patch('os.cpu_count', return_value=2):
+        with pytest.raises(git.GitCommandError):
+            repo.branch.cherry_many(pairs)
+    assert running.proc.kill.called is True
+    assert running.proc.wait.called is True
+
+
+def test_cherry_many_equivalent(mock_repo, git_process):
+    """
+    GIVEN GitRepo initialized with a path and repo
+    WHEN cherry_many is called with equivalent set
+    THEN a dictionary of equivalent patches is returned for each pair
+    """
+    repo = GitRepo('./', mock_repo)
+    mock_repo.git.cherry.side_effect = (
+        lambda *args, **kwargs: git_process('+ sha1 commit1\n- sha2 commit2')
+    )
+    expected = {('upstream', 'HEAD'): {'sha2': 'commit2'},
+                ('upstream', 'other'): {'sha2': 'commit2'}}
+    pairs = [('upstream', 'HEAD'), ('upstream', 'other')]
+    assert expected == repo.branch.cherry_many(pairs, equivalent=True)
+
+
 def test_rebase(mock_repo):
     """
     GIVEN GitRepo initialized with a path and repo
@@ -151,6 +238,79 @@ def test_rebase_dirty_repo(mock_repo):
     assert mock_repo.is_dirty.called is True
 
 
+def test_rebase_in_batch(mock_repo):
+    """
+    GIVEN GitRepo initialized with a path and repo
+    WHEN branch.rebase_to_hash is called several times inside branch.batch
+    THEN the repository is only checked for changes once
+    """
+    mock_repo.is_dirty.return_value = False
+    repo = GitRepo('./', mock_repo)
+
+    with patch('git.repo.fun.name_to_object'):
+        with repo.branch.batch():
+            repo.branch.rebase_to_hash('test', '12345')
+            repo.branch.rebase_to_hash('test2', '12345')
+            repo.branch.apply_diff('test', './requirements.txt', 'message')
+
+    assert mock_repo.is_dirty.call_count == 2
+    assert repo.repo.git.rebase.call_count == 2
+
+
+def test_rebase_in_batch_after_error(mock_repo):
+    """
+    GIVEN GitRepo initialized with a path and repo
+    WHEN branch.rebase_to_hash fails inside branch.batch
+    THEN the repository is checked for changes again on the next call
+    """
+    mock_repo.is_dirty.return_value = False
+    mock_repo.git.rebase.side_effect = [git.GitCommandError('rebase', ''),
+                                        None]
+    repo = GitRepo('./', mock_repo)
+
+    with patch('git.repo.fun.name_to_object'):
+        with repo.branch.batch():
+            with pytest.raises(exceptions.RebaseException):
+                repo.branch.rebase_to_hash('test', '12345')
+            repo.branch.rebase_to_hash('test', '12345')
+
+    assert mock_repo.is_dirty.call_count == 2
+
+
+def test_rebase_holds_worktree_lock(mock_repo):
+    """
+    GIVEN GitRepo initialized with a path and repo
+    WHEN branch.rebase_to_hash is called
+    THEN the working tree is locked for other threads during the rebase
+    AND unlocked afterwards
+    """
+    mock_repo.is_dirty.return_value = False
+    repo = GitRepo('./', mock_repo)
+    lock = _worktree_lock(mock_repo.working_dir)
+
+    def try_lock():
+        acquired = []
+        thread = threading.Thread(
+            target=lambda: acquired.append(lock.acquire(blocking=False))
+        )
+        thread.start()
+        thread.join()
+        if acquired[0]:
+            lock.release()
+        return acquired[0]
+
+    locked_during_rebase = []
+    mock_repo.git.rebase.side_effect = (
+        lambda *args: locked_during_rebase.append(not try_lock())
+    )
+
+    with patch('git.repo.fun.name_to_object'):
+        repo.branch.rebase_to_hash('test', '12345')
+
+    assert locked_during_rebase == [True]
+    assert try_lock() is True
+
+
 def test_rebase_branch_not_found(mock_repo):
     """
     GIVEN GitRepo initialized with a path and repo
@@ -278,6 +438,56 @@ def test_apply_patch_with_brackets_preserved(mock_repo):
     repo.git.am.assert_called_with('--keep-non-patch', ANY)
 
 
+def test_apply_patches(mock_repo):
+    """
+    GIVEN GitRepo initialized with a path and repo
+    WHEN apply_patches is called with a valid branch name and several paths
+    THEN git.checkout is called once
+    AND git.am is called once with all the paths in order
+    """
+    repo = GitRepo('./', mock_repo)
+
+    with patch('git.repo.fun.name_to_object'):
+        repo.branch.apply_patches('test_branch',
+                                  ['./requirements.txt', './setup.py'])
+    assert repo.git.checkout.call_count == 1
+    repo.git.am.assert_called_once_with(
+        os.path.abspath('requirements.txt'), os.path.abspath('setup.py')
+    )
+
+
+def test_apply_patches_with_brackets_preserved(mock_repo):
+    """
+    GIVEN GitRepo initialized with a path and repo
+    WHEN apply_patches is called with keep_square_brackets set
+    THEN git.am is called with the --keep-non-patch option before the paths
+    """
+    repo = GitRepo('./', mock_repo)
+
+    with patch('git.repo.fun.name_to_object'):
+        repo.branch.apply_patches('test_branch',
+                                  ['./requirements.txt', './setup.py'],
+                                  keep_square_brackets=True)
+    repo.git.am.assert_called_once_with('--keep-non-patch', ANY, ANY)
+
+
+def test_apply_patches_one_missing_file(mock_repo):
+    """
+    GIVEN GitRepo initialized with a path and repo
+    WHEN apply_patches is called and one of the paths isn't a file
+    THEN FileDoesntExistException is raised
+    AND neither git.checkout nor git.am are called
+    """
+    repo = GitRepo('./', mock_repo)
+
+    with patch('git.repo.fun.name_to_object'):
+        with pytest.raises(exceptions.FileDoesntExistException):
+            repo.branch.apply_patches('test_branch',
+                                      ['./requirements.txt', './git_wrapper'])
+    assert repo.git.checkout.called is False
+    assert repo.git.am.called is False
+
+
 def test_apply_patch_wrong_branch_name(mock_repo):
     """
     GIVEN GitRepo initialized with a path and repo
@@ -309,6 +519,21 @@ def test_apply_patch_not_a_file(mock_repo):
     assert repo.git.am.called is False
 
 
+def test_apply_patch_missing_file(mock_repo):
+    """
+    GIVEN GitRepo initialized with a path and repo
+    WHEN apply_patch is called with a path that doesn't exist
+    THEN FileDoesntExistException is raised
+    AND git.am not called
+    """
+    repo = GitRepo('./', mock_repo)
+
+    with patch('git.repo.fun.name_to_object'):
+        with pytest.raises(exceptions.FileDoesntExistException):
+            repo.branch.apply_patch('test_branch', './doesnt-exist.patch')
+    assert repo.git.am.called is False
+
+
 def test_apply_patch_checkout_error(mock_repo):
     """
     GIVEN GitRepo initialized with a path and repo
@@ -352,8 +577,8 @@ def test_apply_diff(mock_repo):
 
     with patch('git.repo.fun.name_to_object'):
         repo.branch.apply_diff('test_branch', './requirements.txt', 'message', True)
-    assert repo.git.add.called is True
-    assert repo.git.apply.called is True
+    repo.git.apply.assert_called_once_with("--index", os.path.abspath('./requirements.txt'))
+    repo.git.add.assert_called_once_with(update=True)
     assert repo.git.commit.called is True
 
 
@@ -552,11 +777,13 @@ def test_reset(mock_repo):
     mock_repo.remote.return_value = mock_remote
 
     repo = GitRepo(repo=mock_repo)
-    with patch('git.repo.fun.name_to_object'):
+    with patch('git.repo.fun.name_to_object') as mock_name_to_object:
         repo.branch.hard_reset()
 
     assert mock_remote.fetch.called is True  # Sync is called
     assert mock_repo.head.reset.called is True  # Reset is called
+    mock_name_to_object.assert_called_with(mock_repo,
+                                           "refs/remotes/origin/master")
 
 
 def test_reset_remote_reference_not_found(mock_repo):
@@ -661,6 +888,23 @@ def test_reset_to_ref_without_checkout(mock_repo):
     assert mock_repo.git.checkout.call_count == 2
 
 
+def test_reset_to_ref_already_on_branch(mock_repo):
+    """
+    GIVEN GitRepo is initialized with a path and repo
+    AND the branch to reset is already checked out
+    WHEN reset_to_ref is called with checkout False
+    THEN repo.head.reset is called
+    AND repo.checkout is not called
+    """
+    mock_repo.head.ref.name = "main"
+    repo = GitRepo(repo=mock_repo)
+    with patch('git.repo.fun.name_to_object'):
+        repo.branch.hard_reset_to_ref("main", "origin/main", checkout=False)
+
+    assert mock_repo.head.reset.called is True
+    assert mock_repo.git.checkout.called is False
+
+
 def test_reset_to_ref_without_checkout_fails(mock_repo):
     """
     GIVEN GitRepo is initialized with a path and repo
@@ -840,6 +1084,23 @@ def test_create_branch_already_exists_and_reset_it(mock_repo):
     assert mock_hard_reset.called is True
 
 
+def test_create_branch_already_exists_reset_and_check_it_out(mock_repo):
+    """
+    GIVEN GitRepo is initialized with a path and repo
+    WHEN branch.create is called with a valid name and start_ref
+    AND the branch already exists and reset_if_exists and checkout are True
+    THEN the branch is only checked out once
+    """
+    repo = GitRepo(repo=mock_repo)
+    mock_repo.branches = ["test", "master"]
+    mock_repo.head.ref.name = "master"
+
+    with patch('git.repo.fun.name_to_object'):
+        repo.branch.create("test", "123456", True, True)
+    repo.git.checkout.assert_called_once_with("test")
+    assert mock_repo.head.reset.called is True
+
+
 def test_remote_contains_branch_not_found(mock_repo):
     """
     GIVEN GitRepo initialized with a path and repo
@@ -880,26 +1141,86 @@ def test_remote_contains_with_commit_present(mock_repo):
     """
     GIVEN GitRepo is initialized with a path and repo
     WHEN branch.remote_contains is called with a valid branch and hash
-    AND git_repo.git.branch returns data
+    AND git merge-base --is-ancestor succeeds
     THEN branch.remote_contains returns True
     """
     remote_branch = "origin/mybranch"
-    mock_repo.git.branch.return_value = remote_branch
     repo = GitRepo(repo=mock_repo)
 
     with patch('git.repo.fun.name_to_object'):
         assert repo.branch.remote_contains(remote_branch, '12345') is True
+    mock_repo.git.merge_base.assert_called_with(
+        "--is-ancestor", "12345", remote_branch, env=READ_ONLY_ENV
+    )
 
 
 def test_remote_contains_with_commit_absent(mock_repo):
     """
     GIVEN GitRepo is initialized with a path and repo
     WHEN branch.remote_contains is called with a valid branch and hash
-    AND git_repo.git.branch returns empty string
-    THEN branch.remote_contains returns True
+    AND git merge-base --is-ancestor exits with status 1
+    THEN branch.remote_contains returns False
     """
-    mock_repo.git.branch.return_value = ""
+    mock_repo.git.merge_base.side_effect = git.GitCommandError('merge-base', 1)
     repo = GitRepo(repo=mock_repo)
 
     with patch('git.repo.fun.name_to_object'):
         assert repo.branch.remote_contains("origin/mybranch", '12345') is False
+
+
+def test_remote_contains_error(mock_repo):
+    """
+    GIVEN GitRepo is initialized with a path and repo
+    WHEN branch.remote_contains is called with a valid branch and hash
+    AND git merge-base fails with another status
+    THEN the git.GitCommandError is raised
+    """
+    mock_repo.git.merge_base.side_effect = git.GitCommandError('merge-base', 128)
+    repo = GitRepo(repo=mock_repo)
+
+    with patch('git.repo.fun.name_to_object'):
+        with pytest.raises(git.GitCommandError):
+            repo.branch.remote_contains("origin/mybranch", '12345')
+
+
+def test_remote_contains_many(mock_repo):
+    """
+    GIVEN GitRepo is initialized with a path and repo
+    WHEN branch.remote_contains_many is called with a valid branch and hashes
+    THEN the remote branch history is listed only once
+    AND whether each hash is present on it is returned
+    """
+    mock_repo.git.rev_list.return_value = "aaaa\nbbbb\ncccc"
+    repo = GitRepo(repo=mock_repo)
+
+    def side_effect(mock, ref):
+        return Mock(type="commit", hexsha=ref * 2)
+
+    with patch('git.repo.fun.name_to_object') as mock_name_to_object:
+        mock_name_to_object.side_effect = side_effect
+        result = repo.branch.remote_contains_many("origin/mybranch",
+                                                  ["aa", "dd", "cc"])
+
+    assert result == {"aa": True, "dd": False, "cc": True}
+    mock_repo.git.rev_list.assert_called_once_with("origin/mybranch",
+                                                   env=READ_ONLY_ENV)
+
+
+def test_remote_contains_many_commit_not_found(mock_repo):
+    """
+    GIVEN GitRepo initialized with a path and repo
+    WHEN branch.remote_contains_many is called with an invalid commit hash
+    THEN a ReferenceNotFoundException is raised
+    AND the remote branch history is not listed
+    """
+    repo = GitRepo(repo=mock_repo)
+
+    with patch('git.repo.fun.name_to_object') as mock_name_to_object:
+        with pytest.raises(exceptions.ReferenceNotFoundException) as exc_info:
+            def side_effect(mock, ref):
+                if ref != "origin/mybranch":
+                    raise git.exc.BadName
+            mock_name_to_object.side_effect = side_effect
+            repo.branch.remote_contains_many('origin/mybranch', ['doesNotExist'])
+    assert 'doesNotExist' in str(exc_info.value)
+    assert mock_repo.git.rev_list.called is False